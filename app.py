@@ -1,28 +1,90 @@
+import functools
+import io
+import itertools
+import json
+import os
 import pathlib
 import pickle
+import sys
+import time
 import eurostat
 import asyncio
 
+import numpy as np
 import pandas as pd
-from shiny import ui, App
+from shiny import reactive, ui, App
 from shinywidgets import output_widget, render_widget
-import plotly.express as px
+import plotly.colors
+import plotly.graph_objects as go
+
+GEO_COLUMN = "geo\\TIME_PERIOD"
+years = np.arange(2000, 2022)
+year_columns = [str(y) for y in years]
 
 
 def filter_data(full_data: pd.DataFrame, filters: dict):
-    filtered_data = full_data
+    mask = np.ones(len(full_data), dtype=bool)
     for filter_key, filter_value in filters.items():
-        filtered_data = filtered_data[filtered_data[filter_key] == filter_value]
-    return filtered_data
+        mask &= (full_data[filter_key] == filter_value).to_numpy(
+            dtype=bool, na_value=False
+        )
+    return full_data.loc[mask]
+
+
+def replace_atomically(path: pathlib.Path, write) -> None:
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
 
+def get_last_update(eurostat_code: str):
+    try:
+        toc = eurostat.get_toc_df()
+    except Exception:
+        # An outage surfaces as anything from a requests error to a gzip or
+        # unbound-name error inside eurostat; treat it as "unknown" and let
+        # the caller fall back to the cache or a plain fetch.
+        return None
+    row = toc[toc["code"].str.upper() == eurostat_code.upper()]
+    if row.empty:
+        return None
+    return str(row["last update of data"].iloc[0])
 
-def get_eurostat_data(cache_path: pathlib.Path = pathlib.Path("data.cache")):
+
+def get_eurostat_data(
+    data_path: pathlib.Path = pathlib.Path("data.parquet"),
+    dicts_path: pathlib.Path = pathlib.Path("dicts.pkl"),
+    meta_path: pathlib.Path = pathlib.Path("cache.meta.json"),
+    cache_ttl: float = 24 * 60 * 60,
+):
     eurostat_code = "GOV_10A_EXP"
 
-    if cache_path.exists():
-        with cache_path.open("rb") as fp:
-            full_data, cat_titles_dict, geo_titles_dict = pickle.load(fp)
+    meta = {}
+    if data_path.exists() and dicts_path.exists() and meta_path.exists():
+        with meta_path.open() as fp:
+            meta = json.load(fp)
+
+    # The table of contents is a large download, so the release timestamp is
+    # only re-checked once the cache is older than cache_ttl.
+    cache_valid = bool(meta)
+    last_update = None
+    if cache_valid and time.time() - meta.get("checked_at", 0) > cache_ttl:
+        last_update = get_last_update(eurostat_code)
+        if last_update is not None and last_update != meta.get("last_update"):
+            cache_valid = False
+        elif last_update is not None:
+            meta["checked_at"] = time.time()
+            replace_atomically(
+                meta_path, lambda path: path.write_text(json.dumps(meta))
+            )
+
+    if cache_valid:
+        full_data = pd.read_parquet(data_path, engine="pyarrow")
+        with dicts_path.open("rb") as fp:
+            cat_titles_dict, geo_titles_dict = pickle.load(fp)
     else:
+        if last_update is None:
+            last_update = get_last_update(eurostat_code)
         data = eurostat.get_data(eurostat_code)
 
         cat_titles = eurostat.get_dic(eurostat_code, "cofog99")
@@ -32,29 +94,193 @@ def get_eurostat_data(cache_path: pathlib.Path = pathlib.Path("data.cache")):
         geo_titles_dict = {x[0]: x[1] for x in geo_titles}
 
         full_data = pd.DataFrame.from_records(data[1:], columns=data[0])
-        full_data["country"] = full_data["geo\TIME_PERIOD"].apply(
-            lambda x: geo_titles_dict[x]
+        for column in (GEO_COLUMN, "cofog99", "sector", "unit", "na_item"):
+            full_data[column] = full_data[column].astype("category")
+        for column in full_data.columns:
+            if not column.isdigit():
+                continue
+            values = full_data[column]
+            if not pd.api.types.is_numeric_dtype(values):
+                # Strip observation flags such as "p" or "e" from the cells.
+                values = values.astype("string").str.extract(
+                    r"([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)", expand=False
+                )
+            full_data[column] = pd.to_numeric(values, errors="coerce").astype("float64")
+
+        # Other workers may be reading the cache, so each file is swapped in
+        # whole and the meta file goes last.
+        replace_atomically(
+            data_path,
+            lambda path: full_data.reset_index(drop=True).to_parquet(
+                path, engine="pyarrow", compression="snappy", index=False
+            ),
         )
-        full_data["category"] = full_data["cofog99"].apply(lambda x: cat_titles_dict[x])
+        replace_atomically(
+            dicts_path,
+            lambda path: path.write_bytes(
+                pickle.dumps(
+                    [cat_titles_dict, geo_titles_dict], protocol=pickle.HIGHEST_PROTOCOL
+                )
+            ),
+        )
+        meta = {"last_update": last_update, "checked_at": time.time()}
+        replace_atomically(meta_path, lambda path: path.write_text(json.dumps(meta)))
 
-        with cache_path.open("wb") as fp:
-            pickle.dump([full_data, cat_titles_dict, geo_titles_dict], fp)
+    for column in full_data.select_dtypes("object"):
+        full_data[column] = full_data[column].astype("string[pyarrow]")
+    cat_titles_dict = {sys.intern(k): v for k, v in cat_titles_dict.items()}
+    geo_titles_dict = {sys.intern(k): v for k, v in geo_titles_dict.items()}
 
     return full_data, cat_titles_dict, geo_titles_dict
 
 
+# Delays a reactive value until it has stopped changing for delay_secs.
+# Used for the year slider so that dragging it by hand builds one figure
+# instead of one per intermediate year. Animation steps are further apart
+# than the delay, so they are not merged, only shown delay_secs later.
+def debounce(delay_secs: float):
+    def wrapper(f):
+        when = reactive.Value(None)
+        trigger = reactive.Value(0)
+
+        @reactive.Calc
+        def cached():
+            return f()
+
+        first_run = True
+
+        @reactive.Effect(priority=102)
+        def primer():
+            nonlocal first_run
+            cached()
+            # The initial value is served directly by debounced(); only
+            # later changes need to wait for the delay.
+            if first_run:
+                first_run = False
+                return
+            when.set(time.time() + delay_secs)
+
+        @reactive.Effect(priority=101)
+        def timer():
+            deadline = when()
+            if deadline is None:
+                return
+            time_left = deadline - time.time()
+            if time_left <= 0:
+                with reactive.isolate():
+                    when.set(None)
+                    trigger.set(trigger() + 1)
+            else:
+                reactive.invalidate_later(time_left)
+
+        @reactive.Calc
+        @reactive.event(trigger)
+        def debounced():
+            return cached()
+
+        return debounced
+
+    return wrapper
+
+
 full_data, cat_titles_dict, geo_titles_dict = get_eurostat_data()
 filtered_data = filter_data(
     full_data, {"sector": "S13", "unit": "PC_GDP", "na_item": "TE"}
 )
+# Every year in the dataset is kept for the CSV download; only the plot is
+# limited to year_columns.
+filtered_data = filtered_data[
+    [GEO_COLUMN, "cofog99"]
+    + [column for column in filtered_data.columns if column.isdigit()]
+]
+filtered_data = filtered_data.sort_values([GEO_COLUMN, "cofog99"]).reset_index(
+    drop=True
+)
+row_groups = filtered_data.groupby([GEO_COLUMN, "cofog99"], observed=True).indices
+
+year_matrix = filtered_data[year_columns].to_numpy(dtype=np.float32)
+geo_codes = filtered_data[GEO_COLUMN].cat.codes.to_numpy(dtype=np.int16)
+cat_codes = filtered_data["cofog99"].cat.codes.to_numpy(dtype=np.int16)
+geo_names = np.array(
+    [geo_titles_dict[code] for code in filtered_data[GEO_COLUMN].cat.categories],
+    dtype=object,
+)
+cat_names = np.array(
+    [cat_titles_dict[code] for code in filtered_data["cofog99"].cat.categories],
+    dtype=object,
+)
 
-uniq_countries = full_data["geo\TIME_PERIOD"].unique().tolist()
+
+def selection_rows(countries, categories) -> np.ndarray:
+    rows = [
+        row_groups[key]
+        for key in itertools.product(countries, categories)
+        if key in row_groups
+    ]
+    return np.concatenate(rows) if rows else np.empty(0, dtype=np.intp)
+
+
+uniq_countries = set(full_data[GEO_COLUMN].unique())
 geo_titles_dict = {
     k: v
     for k, v in sorted(geo_titles_dict.items(), key=lambda x: x[1])
     if k in uniq_countries
 }
 cat_titles_dict = {k: v for k, v in sorted(cat_titles_dict.items(), key=lambda x: x[1])}
+cat_choices = {k: v for k, v in cat_titles_dict.items() if len(k) < 5}
+
+# Colors are fixed per country so a country keeps its color whatever else
+# is selected.
+colors = plotly.colors.qualitative.Plotly
+figure_template = go.Figure(
+    data=[
+        go.Bar(
+            name=name,
+            orientation="h",
+            marker_color=colors[i % len(colors)],
+            texttemplate="%{x:.2%}",
+            hovertemplate=(
+                f"Country={name}<br>% GDP=%{{x:.2%}}<br>%{{y}}<extra></extra>"
+            ),
+            visible=False,
+        )
+        for i, name in enumerate(geo_titles_dict.values())
+    ],
+    layout=go.Layout(
+        barmode="group",
+        font={"size": 15},
+        legend_title_text="Country",
+        xaxis={"title": "% GDP", "tickformat": ".2%"},
+        yaxis={"title": ""},
+    ),
+)
+trace_index = {name: i for i, name in enumerate(geo_titles_dict.values())}
+
+
+@functools.lru_cache(maxsize=256)
+def build_figure(year: int, countries: tuple, categories: tuple):
+    rows = selection_rows(countries, categories)
+    values = year_matrix[rows, year - years[0]] / 100
+    present = ~np.isnan(values)
+    rows, values = rows[present], values[present]
+    plot_data = pd.DataFrame(
+        {
+            "country": geo_names[geo_codes[rows]],
+            "category": cat_names[cat_codes[rows]],
+            "value": values,
+        }
+    )
+
+    fig = go.Figure(figure_template)
+    for country, country_data in plot_data.groupby("country", sort=False):
+        trace = fig.data[trace_index[country]]
+        trace.x = country_data["value"].to_numpy()
+        trace.y = country_data["category"].to_numpy()
+        trace.visible = True
+    fig.layout.title.text = f"Budget as a percentage of GDP ({year})"
+    fig.layout.height = 220 + len(categories) * (len(countries) * 30)
+    return fig
+
 
 home_tab = ui.nav("About",
     ui.panel_title("Welcome to Eurostat visualizer"), 
@@ -67,16 +293,16 @@ budget_tab = ui.nav("Budget comparisons",
             ui.input_slider(
                 "year",
                 "Choose a year:",
-                2000,
-                2021,
-                2021,
+                int(years[0]),
+                int(years[-1]),
+                int(years[-1]),
                 sep="",
                 animate=ui.AnimationOptions(interval=1000, loop=False),
             ),
             ui.input_select(
                 "plot_cat_code",
                 label="Category",
-                choices={k: v for k, v in cat_titles_dict.items() if len(k) < 5},
+                choices=cat_choices,
                 multiple=True,
                 size=7
             ),
@@ -103,53 +329,35 @@ app_ui = ui.page_fluid(
 
 
 def server(input, output, session):
+    year_debounced = debounce(0.2)(input.year)
+
     @output
     @render_widget
     def my_widget():
         if len(input.country()) < 1 or len(input.plot_cat_code()) < 1:
             return None
 
-        plot_data = filtered_data[
-            filtered_data["geo\TIME_PERIOD"]
-            .apply(lambda x: x in input.country())
-            .tolist()
-        ]
-        plot_data = plot_data[
-            plot_data["cofog99"].apply(lambda x: x in input.plot_cat_code()).tolist()
-        ]
-        plot_data["value"] = plot_data[str(input.year())] / 100
-
-        fig = px.bar(
-            plot_data,
-            x="value",
-            y="category",
-            color="country",
-            text_auto=".2%",
-            title=f"Budget as a percentage of GDP ({input.year()})",
-            barmode="group",
-            labels={"category": "", "value": "% GDP", "country": "Country"},
+        return go.Figure(
+            build_figure(
+                year_debounced(),
+                tuple(input.country()),
+                tuple(input.plot_cat_code()),
+            )
         )
-        fig.update_xaxes(tickformat=".2%")
-        fig.update_layout(
-            font={"size": 15}
-        )
-        fig.layout.height = 220 + len(input.plot_cat_code()) * (len(input.country()) * 30)
-        return fig
 
     @session.download(filename=lambda: f"data.csv")
     async def download_data():
-        plot_data = filtered_data[
-            filtered_data["geo\TIME_PERIOD"]
-            .apply(lambda x: x in input.country())
-            .tolist()
-        ]
-        plot_data = plot_data[
-            plot_data["cofog99"].apply(lambda x: x in input.plot_cat_code()).tolist()
-        ]
-        await asyncio.sleep(0.25)
-
-        csv_rows = plot_data.to_csv()
-        yield csv_rows
+        rows = selection_rows(input.country(), input.plot_cat_code())
+        plot_data = filtered_data.iloc[rows].copy()
+        plot_data["country"] = geo_names[geo_codes[rows]]
+        plot_data["category"] = cat_names[cat_codes[rows]]
+
+        buffer = io.StringIO()
+        plot_data.to_csv(buffer, index=False, chunksize=4096)
+        buffer.seek(0)
+        while chunk := buffer.read(65536):
+            yield chunk
+            await asyncio.sleep(0)
 
 
 app = App(app_ui, server)